@@ -1,15 +1,26 @@
+import os
 import warnings
+from concurrent.futures import ThreadPoolExecutor
 from typing import Iterable
 
 import cv2
 import deprecation
 import numpy as np
 import pandas as pd
-from scipy.ndimage.measurements import center_of_mass
-from skimage import measure
+from scipy import ndimage
+from skimage.util import map_array
+
+try:
+    import cc3d
+except ImportError:
+    cc3d = None
+
+try:
+    import numba
+except ImportError:
+    numba = None
 
 from . import __version__, metrics
-from .pandaslib import df_empty
 
 __all__ = [
     "load_iuv",
@@ -17,6 +28,7 @@ __all__ = [
     "plot_centroids",
     "filter_parts",
     "remap_parts",
+    "remap_parts_composed",
     "semantic_remap_dict2remap_dict",
     "compute_iou",
     "resize_labels",
@@ -41,7 +53,8 @@ def load_iuv(iuv_path):
         channel of v coordinates
     """
     iuv = cv2.imread(iuv_path, -1)
-    i, u, v = list(map(np.squeeze, np.dsplit(iuv, 3)))
+    # cv2.split returns contiguous copies instead of strided views
+    i, u, v = cv2.split(iuv)
     return i, u, v
 
 
@@ -86,32 +99,63 @@ def calculate_centroids(labels, cca=False, background=0):
     ax.imshow(I[0])
     plot_centroids(ax, centroids, texts)
     """
-    unique_labels = np.unique(labels)
-    unique_labels = set(unique_labels) - set([background])
-    label_masks = [labels == label_id for label_id in unique_labels]
-
-    def _calc_centroid(x):
-        """ the actual calc centroid function """
-        return np.array(center_of_mass(x)).astype(np.int)
+    labels = np.asarray(labels)
+    unique_labels, label_index = np.unique(labels, return_inverse=True)
+    label_index = label_index.reshape(labels.shape)
+    foreground = unique_labels != background
 
     centroids = []
     centroid_labels = []
-    for label_mask, label_id in zip(label_masks, unique_labels):
-        if cca:
-            connected_labels = measure.label(label_mask)
-            connected_ids = set(np.unique(connected_labels))
-            connected_ids -= set([0])  # suppress background
-            connected_masks = [connected_labels == cid for cid in connected_ids]
-            current_centroids = list(map(_calc_centroid, connected_masks))
+    if cca and cc3d is not None and labels.ndim in (2, 3):
+        # label the connected components of all parts in a single pass,
+        # with the background as 0
+        part_index = np.where(foreground[label_index], label_index + 1, 0)
+        connected_labels = cc3d.connected_components(
+            part_index, connectivity=3 ** labels.ndim - 1
+        ).astype(np.intp, copy=False)
+        component_parts = np.zeros(connected_labels.max() + 1, dtype=np.int64)
+        component_parts[connected_labels.ravel()] = part_index.ravel()
+        # suppress background and group components by part
+        component_parts = component_parts[1:] - 1
+        component_centroids = _calc_centroids(connected_labels)[1:]
+        order = np.argsort(component_parts, kind="stable")
+        centroids = list(component_centroids[order])
+        centroid_labels = list(unique_labels[component_parts[order]])
+    elif cca:
+        # full connectivity, same as skimage.measure.label
+        structure = ndimage.generate_binary_structure(labels.ndim, labels.ndim)
+        for label_id in unique_labels[foreground]:
+            label_mask = labels == label_id
+            connected_labels, num_components = ndimage.label(label_mask, structure)
+            current_centroids = ndimage.center_of_mass(
+                label_mask, connected_labels, np.arange(1, num_components + 1)
+            )
+            current_centroids = list(np.array(current_centroids).astype(int))
             centroids += current_centroids
             centroid_labels += [label_id] * len(current_centroids)
-        else:
-            current_centroids = _calc_centroid(label_mask)
-            centroids.append(current_centroids)
-            centroid_labels.append(label_id)
+    else:
+        centroids = list(_calc_centroids(label_index)[foreground])
+        centroid_labels = list(unique_labels[foreground])
     return centroids, centroid_labels
 
 
+def _calc_centroids(index_map):
+    """Centroids in pixel coordinates of every value 0, ..., index_map.max()
+    of a non-negative int array, using one weighted bincount per axis."""
+    flat_index = index_map.ravel()
+    counts = np.bincount(flat_index)
+    coordinate_sums = []
+    for axis, axis_length in enumerate(index_map.shape):
+        coordinates = np.arange(axis_length).reshape(
+            [-1 if a == axis else 1 for a in range(index_map.ndim)]
+        )
+        coordinates = np.broadcast_to(coordinates, index_map.shape).ravel()
+        coordinate_sums.append(np.bincount(flat_index, weights=coordinates))
+    with np.errstate(divide="ignore", invalid="ignore"):
+        centroids = np.stack(coordinate_sums, axis=1) / counts[:, np.newaxis]
+    return centroids.astype(int)
+
+
 def plot_centroids(ax, centroids, texts):
     """
     plot centroid points into image given axis and texts.
@@ -145,12 +189,18 @@ def plot_centroids(ax, centroids, texts):
     ax.imshow(I[0])
     plot_centroids(ax, centroids, texts)
     """
+    # like zip, only plot as many centroids as there are texts and vice versa
+    texts = list(texts)
+    centroids = list(centroids)[: len(texts)]
+    if len(centroids) == 0:
+        return
     props = dict(boxstyle="round", facecolor="wheat", alpha=0.5)
-    for p, t in zip(centroids, texts):
-        if np.all(p > 0):
-            ax.text(
-                p[1], p[0], t, fontsize=10, bbox=props, horizontalalignment="center"
-            )
+    centroids = np.reshape(centroids, (len(centroids), -1))
+    for i in np.flatnonzero(np.all(centroids > 0, axis=1)):
+        p = centroids[i]
+        ax.text(
+            p[1], p[0], texts[i], fontsize=10, bbox=props, horizontalalignment="center"
+        )
 
 
 def filter_parts(part_map, included_parts):
@@ -166,14 +216,34 @@ def filter_parts(part_map, included_parts):
     new_part_map : np.ndarray
         an array where only included parts are present.
     """
-    new_part_map = np.zeros_like(part_map)
-    for i in included_parts:
-        mask = part_map == i
-        new_part_map[mask] = part_map[mask]
-    return new_part_map
-
-
-def remap_parts(part_map, remap_dict):
+    part_map = np.asarray(part_map)
+    if not isinstance(included_parts, np.ndarray):
+        # accept any iterable of part ids, e.g. sets
+        included_parts = list(included_parts)
+    included_parts = np.asarray(included_parts).ravel()
+    if part_map.dtype == bool:
+        # treat bool labels as 0 and 1
+        return filter_parts(part_map.view(np.uint8), included_parts).view(bool)
+    if part_map.size == 0 or included_parts.size == 0:
+        return np.zeros_like(part_map)
+    integer_labels = np.issubdtype(part_map.dtype, np.integer)
+    max_label = int(part_map.max()) if integer_labels else None
+    if not integer_labels or part_map.min() < 0 or max_label >= part_map.size:
+        # labels that can not index a LUT of reasonable size, e.g. floats
+        keep_mask = np.isin(part_map, included_parts)
+        return np.where(keep_mask, part_map, 0).astype(part_map.dtype, copy=False)
+    # identity LUT with all excluded labels set to 0
+    lut = np.zeros(max_label + 1, dtype=part_map.dtype)
+    included_parts = included_parts[
+        (included_parts >= 0)
+        & (included_parts <= max_label)
+        & (np.mod(included_parts, 1) == 0)
+    ].astype(np.int64)
+    lut[included_parts] = included_parts
+    return _lut_gather(lut, part_map)
+
+
+def remap_parts(part_map, remap_dict, dtype=None):
     """
     remaps labels according to a remapping dictionary.
 
@@ -182,6 +252,10 @@ def remap_parts(part_map, remap_dict):
     remap_dict : dict
         a dict where each key is an int giving the original part id and
         each value is an int giving the new part id
+    dtype : np.dtype, optional
+        dtype of the returned array. Defaults to the dtype of `part_map`.
+        Use np.uint8 when all new part ids are smaller than 256 to reduce
+        memory traffic.
 
     returns
     new_part_map : ndarray
@@ -245,11 +319,106 @@ def remap_parts(part_map, remap_dict):
         texts = list(map(lambda x: new_part_list[x], centroid_labels))
         denseposelib.plot_centroids(ax, centroids, texts)
     """
-    new_part_map = np.zeros_like(part_map)
+    return _remap_parts(part_map, remap_dict, dtype)
+
+
+def remap_parts_composed(part_map, remap_dict, *remap_dicts, dtype=None):
+    """
+    remaps labels according to a chain of remapping dictionaries.
+
+    The result is the same as applying @remap_parts with each dictionary in
+    turn, but the dictionaries are composed into a single LUT first so that
+    `part_map` is only traversed once.
+
+    part_map : ndarray
+        an array of part labels (int) for each pixel location
+    remap_dict, *remap_dicts : dict
+        dicts where each key is an int giving the original part id and
+        each value is an int giving the new part id.
+        They are applied from left to right.
+    dtype : np.dtype, optional
+        dtype of the returned array. Defaults to the dtype of `part_map`.
+
+    returns
+    new_part_map : ndarray
+        an array with new labels
+
+    Example:
+
+        remapped_gt = remap_parts_composed(gt, dp_remap_dict, semantic_remap_dict)
+    """
+    composed_dict = dict(remap_dict)
+    # labels missing from a dict are mapped to 0 by remap_parts
+    default = 0
+    for next_dict in remap_dicts:
+        composed_dict = {
+            old_id: next_dict.get(new_id, 0) for old_id, new_id in composed_dict.items()
+        }
+        default = next_dict.get(default, 0)
+    return _remap_parts(part_map, composed_dict, dtype, default=default)
+
+
+def _remap_parts(part_map, remap_dict, dtype=None, default=0):
+    """remap_parts where labels missing from remap_dict are mapped to `default`."""
+    part_map = np.asarray(part_map)
+    dtype = part_map.dtype if dtype is None else np.dtype(dtype)
+    if part_map.size == 0 or len(remap_dict) == 0:
+        return np.full(part_map.shape, default, dtype=dtype)
+    if part_map.dtype == bool:
+        # treat bool labels as 0 and 1
+        part_map = part_map.view(np.uint8)
+    if not np.issubdtype(part_map.dtype, np.integer):
+        # labels that can not be used as indices, e.g. floats
+        label_values, label_index = np.unique(part_map, return_inverse=True)
+        lut = np.full(len(label_values), default, dtype=dtype)
+        for old_id, new_id in remap_dict.items():
+            lut[label_values == old_id] = new_id
+        return _lut_gather(lut, label_index.reshape(part_map.shape))
+    # an integer map can only contain integral labels, so cast integral keys
+    # such as 1.0 and drop keys such as 1.5
+    remap_dict = {
+        int(old_id): new_id
+        for old_id, new_id in remap_dict.items()
+        if float(old_id).is_integer()
+    }
+    if part_map.dtype == np.uint8:
+        # every possible label fits into a 256 entry LUT,
+        # so there is no need to scan the image for its label range
+        lut_size = 256
+    else:
+        max_label = int(part_map.max())
+        if part_map.min() < 0 or max_label >= part_map.size:
+            # a dense LUT would be larger than the image itself,
+            # so fall back to a sparse lookup
+            old_ids = np.array(list(remap_dict.keys()), dtype=part_map.dtype)
+            new_ids = np.array(list(remap_dict.values()), dtype=dtype)
+            new_part_map = map_array(part_map, old_ids, new_ids)
+            if default != 0:
+                new_part_map[~np.isin(part_map, old_ids)] = default
+            return new_part_map
+        lut_size = max_label + 1
+    lut = np.full(lut_size, default, dtype=dtype)
     for old_id, new_id in remap_dict.items():
-        mask = part_map == old_id
-        new_part_map[mask] = new_id
-    return new_part_map
+        if 0 <= old_id < lut_size:
+            lut[old_id] = new_id
+    return _lut_gather(lut, part_map)
+
+
+def _lut_gather(lut, index_map):
+    """Returns `lut[index_map]`, parallelized with numba if it is available."""
+    if numba is None:
+        return lut[index_map]
+    out = np.empty(index_map.shape, dtype=lut.dtype)
+    _lut_gather_kernel(lut, np.ravel(index_map), out.reshape(-1))
+    return out
+
+
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _lut_gather_kernel(lut, index_map, out):
+        for i in numba.prange(index_map.shape[0]):
+            out[i] = lut[index_map[i]]
 
 
 def semantic_remap_dict2remap_dict(semantic_remap_dict, new_part_list):
@@ -298,10 +467,11 @@ def semantic_remap_dict2remap_dict(semantic_remap_dict, new_part_list):
         remap_dict = semantic_remap_dict2remap_dict(semantic_remap_dict, new_part_list)
 
     """
-    remap_dict = {}
-    for i, new_label in enumerate(new_part_list):
-        old_keys = semantic_remap_dict[new_label]
-        remap_dict.update({PART_LIST.index(o): i for o in old_keys})
+    remap_dict = {
+        _PART_DICT_STR2ID[o]: i
+        for i, new_label in enumerate(new_part_list)
+        for o in semantic_remap_dict[new_label]
+    }
     return remap_dict
 
 
@@ -321,20 +491,92 @@ def compute_iou(pred, label):
     unique_labels : ndarray of shape [n]
         array with unique labels in of GT label array
     """
-    unique_labels = np.unique(label)
-    num_unique_labels = len(unique_labels)
+    confusion, class_labels = _confusion_matrices(
+        np.ravel(pred)[None], np.ravel(label)[None]
+    )
+    iou, unique_classes = _iou_from_confusion_matrix(confusion[0])
+    return iou, class_labels[unique_classes]
 
-    Intersection = np.zeros(num_unique_labels)
-    Union = np.zeros(num_unique_labels)
 
-    for index, val in enumerate(unique_labels):
-        pred_i = pred == val
-        label_i = label == val
+def _confusion_matrices(predicted, target):
+    """Confusion matrices for each (predicted, target) pair along axis 0.
+
+    Predictions are counted along axis 1 and targets along axis 2 of the
+    resulting [N, K, K] array. Also returns the label value of each of the
+    K classes.
+    """
+    predicted = np.asarray(predicted)
+    target = np.asarray(target)
+    N = len(predicted)
+    if predicted.size == 0:
+        # empty batch or empty images, there is nothing to count
+        class_labels = np.array([], dtype=np.result_type(predicted, target))
+        return np.zeros((N, 0, 0), dtype=np.int64), class_labels
+    predicted = np.reshape(predicted, (N, -1))
+    target = np.reshape(target, (N, -1))
+    num_pixels = predicted.shape[1]
+    integer_labels = np.issubdtype(predicted.dtype, np.integer) and np.issubdtype(
+        target.dtype, np.integer
+    )
+    if integer_labels:
+        min_label = min(predicted.min(), target.min())
+        num_classes = int(max(predicted.max(), target.max())) + 1
+    if not integer_labels or min_label < 0 or num_classes * num_classes > num_pixels:
+        # non-integer and negative labels can not be used as indices and a
+        # dense histogram over all label values may be larger than the images,
+        # so only count the label values that occur
+        class_labels, class_index = np.unique(
+            np.concatenate([predicted.ravel(), target.ravel()]), return_inverse=True
+        )
+        class_index = class_index.reshape(2 * N, num_pixels)
+        predicted, target = class_index[:N], class_index[N:]
+        num_classes = len(class_labels)
+    else:
+        class_labels = np.arange(num_classes)
+    if numba is not None:
+        # split each sample into chunks with private accumulators,
+        # so that all threads are busy even for small batches.
+        # The accumulators are capped to the size of the images.
+        num_chunks = -(-numba.get_num_threads() // N)
+        num_chunks = max(1, min(num_chunks, num_pixels // (num_classes * num_classes)))
+        confusion = np.zeros((N, num_chunks, num_classes, num_classes), dtype=np.int64)
+        _confusion_matrices_kernel(predicted, target, confusion)
+        return confusion.sum(axis=1), class_labels
+    predicted = predicted.astype(np.int64, copy=False)
+    target = target.astype(np.int64, copy=False)
+    # offset each sample so that a single bincount covers the whole batch
+    offsets = np.arange(N, dtype=np.int64)[:, None] * num_classes * num_classes
+    confusion = np.bincount(
+        (offsets + predicted * num_classes + target).ravel(),
+        minlength=N * num_classes * num_classes,
+    )
+    return confusion.reshape(N, num_classes, num_classes), class_labels
 
-        Intersection[index] = float(np.sum(np.logical_and(label_i, pred_i)))
-        Union[index] = float(np.sum(np.logical_or(label_i, pred_i)))
 
-    return Intersection / Union, unique_labels
+if numba is not None:
+
+    @numba.njit(parallel=True, cache=True)
+    def _confusion_matrices_kernel(predicted, target, out):
+        num_samples, num_chunks = out.shape[:2]
+        num_pixels = predicted.shape[1]
+        chunk_size = (num_pixels + num_chunks - 1) // num_chunks
+        for job in numba.prange(num_samples * num_chunks):
+            n = job // num_chunks
+            chunk = job % num_chunks
+            start = chunk * chunk_size
+            stop = min(start + chunk_size, num_pixels)
+            for i in range(start, stop):
+                out[n, chunk, predicted[n, i], target[n, i]] += 1
+
+
+def _iou_from_confusion_matrix(confusion):
+    """IOU for each label that occurs in the target of a confusion matrix
+    with predictions along axis 0 and targets along axis 1."""
+    Intersection = np.diag(confusion).astype(np.float64)
+    label_counts = confusion.sum(axis=0)
+    Union = label_counts + confusion.sum(axis=1) - Intersection
+    unique_labels = np.flatnonzero(label_counts)
+    return Intersection[unique_labels] / Union[unique_labels], unique_labels
 
 
 @deprecation.deprecated(
@@ -372,15 +614,14 @@ def resize_labels(labels, size):
     if len(labels.shape) == 2:
         return cv2.resize(labels, size, interpolation=cv2.INTER_NEAREST)
     elif len(labels.shape) == 3:
-        label_list = np.split(labels, labels.shape[0], axis=0)
-        label_list = list(
-            map(
-                lambda x: cv2.resize(
-                    np.squeeze(x), size, interpolation=cv2.INTER_NEAREST
-                ),
-                label_list,
+        # cv2.resize releases the GIL, so slices can be resized in parallel
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            label_list = list(
+                executor.map(
+                    lambda x: cv2.resize(x, size, interpolation=cv2.INTER_NEAREST),
+                    labels,
+                )
             )
-        )
         labels = np.stack(label_list, axis=0)
         return labels
     else:
@@ -426,29 +667,22 @@ def calculate_iou_df(
         df = calculate_iou_df(predicted, target, label_names)
         print(df)
         >>> batch_idx  zeros  ones  twos  threes
-        >>>  0.0    0.0   0.5   0.0    -1.0
-        >>>  1.0    0.0   0.5   0.0    -1.0
+        >>>  0    0.0   0.5   0.0    -1.0
+        >>>  1    0.0   0.5   0.0    -1.0
         # ...
     """
 
-    # df = pd.DataFrame(columns=["batch_idx"] + label_names)
-    column_names = ["batch_idx"] + label_names
-    dtypes = [np.int32] + [np.float32] * len(label_names)
-    df = df_empty(column_names, dtypes)
+    label_names = list(label_names)
+    num_labels = len(label_names)
+    ious = np.full((len(predicted), num_labels), -1.0, dtype=np.float32)
+    confusion, class_labels = _confusion_matrices(predicted, target)
     for batch_idx in range(len(predicted)):
-        current_inferred = predicted[batch_idx]
-        current_gt = target[batch_idx]
-        iou, iou_labels = compute_iou(current_inferred, current_gt)
-        df_update = {p: -1.0 for p in label_names}
-        df_update.update(
-            {
-                p: float(np.squeeze(iou[pi == iou_labels]))
-                for pi, p in enumerate(label_names)
-                if pi in iou_labels
-            }
-        )
-        df_update.update({"batch_idx": batch_idx})
-        df = df.append(df_update, ignore_index=True)
+        iou, unique_classes = _iou_from_confusion_matrix(confusion[batch_idx])
+        iou_labels = class_labels[unique_classes]
+        in_range = (iou_labels >= 0) & (iou_labels < num_labels)
+        ious[batch_idx, iou_labels[in_range]] = iou[in_range]
+    df = pd.DataFrame(ious, columns=label_names)
+    df.insert(0, "batch_idx", np.arange(len(predicted), dtype=np.int32))
     return df
 
 
@@ -489,10 +723,9 @@ def calculate_overall_iou_from_df(
 
     """
 
-    df_mean = df[df != -1].mean().to_frame().transpose()
-    df_mean["overall"] = df_mean[
-        filter(lambda x: x not in exclude_columns, df.columns)
-    ].mean(axis=1)
+    included_columns = [c for c in df.columns if c not in exclude_columns]
+    df_mean = df.mask(df == -1).mean().to_frame().transpose()
+    df_mean["overall"] = df_mean[included_columns].mean(axis=1)
     return df_mean
 
 
@@ -545,3 +778,4 @@ PART_DICT_ID2STR = {
 }
 
 PART_LIST = list(PART_DICT_ID2STR.values())
+_PART_DICT_STR2ID = {v: k for k, v in PART_DICT_ID2STR.items()}
@@ -2,6 +2,30 @@ import pytest
 import numpy as np
 
 
+@pytest.fixture(params=[True, False], ids=["numba", "no_numba"])
+def use_numba(request, monkeypatch):
+    """Run a test with the numba kernels and with the NumPy fallbacks."""
+    from supermariopy import denseposelib
+
+    if request.param:
+        pytest.importorskip("numba")
+    else:
+        monkeypatch.setattr(denseposelib, "numba", None)
+    return request.param
+
+
+@pytest.fixture(params=[True, False], ids=["cc3d", "no_cc3d"])
+def use_cc3d(request, monkeypatch):
+    """Run a test with cc3d and with the scipy.ndimage fallback."""
+    from supermariopy import denseposelib
+
+    if request.param:
+        pytest.importorskip("cc3d")
+    else:
+        monkeypatch.setattr(denseposelib, "cc3d", None)
+    return request.param
+
+
 class Test_denseposelib:
     @pytest.mark.parametrize(
         "in_shape,out_shape", [((256, 256), (128, 128)), ((3, 256, 256), (3, 128, 128))]
@@ -13,6 +37,7 @@ class Test_denseposelib:
         resized = resize_labels(labels, out_shape[-2:])
         assert resized.shape == out_shape
 
+    @pytest.mark.usefixtures("use_numba")
     def test_compute_iou(self):
         from supermariopy.denseposelib import compute_iou
 
@@ -32,6 +57,7 @@ class Test_denseposelib:
 
         assert (float(iou[unique_labels == 1])) == 0.75
 
+    @pytest.mark.usefixtures("use_numba")
     def test_calculate_iou_df(self):
         from supermariopy.denseposelib import calculate_iou_df
 
@@ -51,6 +77,10 @@ class Test_denseposelib:
         assert np.allclose(df.ones, np.ones((10,)) * 0.5)
         assert np.allclose(df.twos, np.zeros((10,)))
         assert np.allclose(df.threes, np.ones((10,)) * -1.0)
+        assert list(df.columns) == ["batch_idx"] + label_names
+        assert df.batch_idx.dtype == np.int32
+        assert np.all(df.batch_idx == np.arange(10))
+        assert all(df[p].dtype == np.float32 for p in label_names)
 
     def test_calculate_overall_iou_from_df(self):
         from supermariopy.denseposelib import (
@@ -95,3 +125,222 @@ class Test_denseposelib:
         remap_dict = compute_best_iou_remapping(predicted_labels, true_labels)
         remapped_labels = remap_parts(predicted_labels, remap_dict)
         assert np.all(remapped_labels == true_labels)
+
+    def test_remap_parts_large_labels(self):
+        from supermariopy.denseposelib import remap_parts
+
+        part_map = np.zeros((10, 10), dtype=np.int)
+        part_map[:5, :5] = 1000
+        part_map[5:, 5:] = 2000
+        remap_dict = {1000: 1, 2000: 2}
+
+        remapped_labels = remap_parts(part_map, remap_dict)
+        expected = np.zeros_like(part_map)
+        expected[:5, :5] = 1
+        expected[5:, 5:] = 2
+        assert np.all(remapped_labels == expected)
+
+    @pytest.mark.usefixtures("use_numba")
+    @pytest.mark.parametrize("size", [10, 40])
+    def test_remap_parts_float_keys(self, size):
+        from supermariopy.denseposelib import remap_parts
+
+        # size 10 uses the sparse fallback, size 40 the dense LUT
+        part_map = np.zeros((size, size), dtype=np.int)
+        part_map[:5, :5] = 1
+        part_map[5:, 5:] = 999
+        remapped_labels = remap_parts(part_map, {1.0: 2, 999.0: 3, 1.5: 4})
+        expected = np.zeros_like(part_map)
+        expected[:5, :5] = 2
+        expected[5:, 5:] = 3
+        assert np.all(remapped_labels == expected)
+
+    def test_filter_parts(self):
+        from supermariopy.denseposelib import filter_parts
+
+        part_map = np.zeros((10, 10), dtype=np.int)
+        part_map[:5, :5] = 1
+        part_map[5:, 5:] = 2
+        part_map[5:, :5] = 3
+
+        filtered = filter_parts(part_map, [1, 3])
+        expected = part_map.copy()
+        expected[5:, 5:] = 0
+        assert np.all(filtered == expected)
+        assert np.all(filter_parts(part_map, {1, 3}) == expected)
+        assert np.all(filter_parts(part_map, {1: "a", 3: "b"}) == expected)
+        assert np.all(filter_parts(part_map, [1.0, 3.0]) == expected)
+
+    @pytest.mark.usefixtures("use_cc3d")
+    @pytest.mark.parametrize("cca", [False, True])
+    def test_calculate_centroids(self, cca):
+        from supermariopy.denseposelib import calculate_centroids
+
+        labels = np.zeros((10, 10), dtype=np.int)
+        labels[:4, :4] = 1
+        labels[6:, 6:] = 2
+
+        centroids, centroid_labels = calculate_centroids(labels, cca=cca)
+        assert list(centroid_labels) == [1, 2]
+        assert np.all(centroids[0] == np.array([1, 1]))
+        assert np.all(centroids[1] == np.array([7, 7]))
+
+        if cca:
+            labels[8:, :2] = 1
+            centroids, centroid_labels = calculate_centroids(labels, cca=cca)
+            assert list(centroid_labels) == [1, 1, 2]
+            assert np.all(centroids[0] == np.array([1, 1]))
+            assert np.all(centroids[1] == np.array([8, 0]))
+            assert np.all(centroids[2] == np.array([7, 7]))
+
+    def test_semantic_remap_dict2remap_dict(self):
+        from supermariopy.denseposelib import semantic_remap_dict2remap_dict
+
+        semantic_remap_dict = {
+            "background": ["background"],
+            "head": ["left_head", "right_head"],
+            "hand": ["right_hand", "left_hand"],
+        }
+        new_part_list = list(semantic_remap_dict.keys())
+        remap_dict = semantic_remap_dict2remap_dict(semantic_remap_dict, new_part_list)
+        assert remap_dict == {0: 0, 23: 1, 24: 1, 3: 2, 4: 2}
+
+    def test_remap_parts_uint8(self):
+        from supermariopy.denseposelib import remap_parts
+
+        part_map = np.random.randint(0, 25, (10, 10))
+        remap_dict = {i: i % 5 for i in range(25)}
+
+        remapped_labels = remap_parts(part_map, remap_dict, dtype=np.uint8)
+        assert remapped_labels.dtype == np.uint8
+        assert np.all(remapped_labels == part_map % 5)
+
+        remapped_labels = remap_parts(part_map.astype(np.uint8), remap_dict)
+        assert remapped_labels.dtype == np.uint8
+        assert np.all(remapped_labels == part_map % 5)
+
+    def test_remap_parts_composed(self):
+        from supermariopy.denseposelib import remap_parts, remap_parts_composed
+
+        part_map = np.random.randint(0, 10, (20, 20))
+        remap_dict_1 = {1: 2, 2: 3, 5: 0}
+        remap_dict_2 = {0: 4, 2: 1, 3: 3}
+
+        expected = remap_parts(remap_parts(part_map, remap_dict_1), remap_dict_2)
+        remapped_labels = remap_parts_composed(part_map, remap_dict_1, remap_dict_2)
+        assert np.all(remapped_labels == expected)
+
+    def test_compute_iou_large_labels(self):
+        from supermariopy.denseposelib import compute_iou
+
+        A = np.zeros((10, 10), dtype=np.uint16)
+        B = np.zeros((10, 10), dtype=np.uint16)
+        A[:5] = 40000
+        B[:, :5] = 40000
+
+        iou, unique_labels = compute_iou(A, B)
+        assert np.all(unique_labels == np.array([0, 40000]))
+        assert np.allclose(iou, np.array([25 / 75, 25 / 75]))
+
+    @pytest.mark.usefixtures("use_numba")
+    def test_compute_iou_negative_labels(self):
+        from supermariopy.denseposelib import compute_iou
+
+        pred = np.array([[0, 1], [-1, 1]])
+        label = np.array([[0, 1], [1, -1]])
+
+        iou, unique_labels = compute_iou(pred, label)
+        assert np.all(unique_labels == np.array([-1, 0, 1]))
+        assert np.allclose(iou, np.array([0.0, 1.0, 1 / 3]))
+
+    @pytest.mark.usefixtures("use_numba")
+    def test_compute_iou_empty(self):
+        from supermariopy.denseposelib import calculate_iou_df, compute_iou
+
+        empty = np.zeros((0, 10), dtype=np.int)
+        iou, unique_labels = compute_iou(empty, empty)
+        assert iou.shape == (0,)
+        assert unique_labels.shape == (0,)
+
+        df = calculate_iou_df(
+            np.zeros((0, 10, 10), dtype=np.int),
+            np.zeros((0, 10, 10), dtype=np.int),
+            ["background", "foreground"],
+        )
+        assert len(df) == 0
+        assert list(df.columns) == ["batch_idx", "background", "foreground"]
+
+    @pytest.mark.usefixtures("use_numba")
+    @pytest.mark.parametrize("dtype", [np.float32, bool])
+    def test_compute_iou_non_integer_labels(self, dtype):
+        from supermariopy.denseposelib import compute_iou
+
+        A = np.ones((10, 10), dtype=np.int)
+        B = np.ones((10, 10), dtype=np.int)
+        B[:5, :5] = 0
+
+        iou, unique_labels = compute_iou(A.astype(dtype), B.astype(dtype))
+        assert np.all(unique_labels == np.array([0, 1]))
+        assert np.allclose(iou, np.array([0.0, 0.75]))
+
+    def test_confusion_matrices_kernel(self):
+        pytest.importorskip("numba")
+        from supermariopy import denseposelib
+
+        predicted = np.random.randint(0, 5, (3, 1000))
+        target = np.random.randint(0, 5, (3, 1000)).astype(np.uint8)
+        num_chunks = 7
+        confusion = np.zeros((3, num_chunks, 5, 5), dtype=np.int64)
+        denseposelib._confusion_matrices_kernel(predicted, target, confusion)
+
+        expected = np.stack(
+            [
+                np.bincount(p * 5 + t, minlength=25).reshape(5, 5)
+                for p, t in zip(predicted, target.astype(np.int64))
+            ]
+        )
+        assert np.all(confusion.sum(axis=1) == expected)
+
+    @pytest.mark.usefixtures("use_numba")
+    def test_remap_and_filter_parts_bool(self):
+        from supermariopy.denseposelib import filter_parts, remap_parts
+
+        part_map = np.zeros((10, 10), dtype=bool)
+        part_map[:5] = True
+
+        remapped_labels = remap_parts(part_map, {0: 1, 1: 0})
+        assert remapped_labels.dtype == bool
+        assert np.all(remapped_labels == ~part_map)
+
+        filtered = filter_parts(part_map, [0])
+        assert filtered.dtype == bool
+        assert not np.any(filtered)
+        assert np.all(filter_parts(part_map, [1]) == part_map)
+
+    def test_remap_and_filter_parts_float(self):
+        from supermariopy.denseposelib import filter_parts, remap_parts
+
+        part_map = np.zeros((10, 10), dtype=np.float32)
+        part_map[:5] = 1.5
+
+        remapped_labels = remap_parts(part_map, {1.5: 2})
+        assert np.all(remapped_labels == (part_map > 0) * 2)
+        assert np.all(filter_parts(part_map, [1.5]) == part_map)
+
+    def test_plot_centroids(self):
+        import matplotlib
+
+        matplotlib.use("Agg")
+        from matplotlib import pyplot as plt
+        from supermariopy.denseposelib import plot_centroids
+
+        centroids = [np.array([1, 2]), np.array([0, 3]), np.array([5, 5])]
+        fig, ax = plt.subplots(1, 1)
+        plot_centroids(ax, centroids, ["a", "b", "c"])
+        assert [t.get_text() for t in ax.texts] == ["a", "c"]
+
+        # like zip, surplus centroids or texts are ignored
+        fig, ax = plt.subplots(1, 1)
+        plot_centroids(ax, centroids, ["a"])
+        assert [t.get_text() for t in ax.texts] == ["a"]
+        plt.close("all")
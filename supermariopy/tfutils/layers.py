@@ -18,6 +18,7 @@ class SPADEResnetBlock(Layer):
         n_channels_x_out,
         use_spectral_norm=False,
         spade_norm=SPADEParamFreeNormType.BATCH_NORM,
+        share_segmap_mlp=False,
     ):
         r"""Implementation of SPADE Residual Block.
         Applies SPADE on x and adds a skip. Does this two times, thus it has two SPADE
@@ -45,6 +46,10 @@ class SPADEResnetBlock(Layer):
         spade_norm : SPADEParamFreeNormType, optional
             which norm each SPADE block uses, by default
             SPADEParamFreeNormType.BATCH_NORM
+        share_segmap_mlp : bool, optional
+            if True, all SPADE blocks share a single `shared_mlp` layer and its
+            activation on the segmap is computed only once per resolution,
+            by default False
 
         Returns
         -------
@@ -87,23 +92,83 @@ class SPADEResnetBlock(Layer):
             #     self.conv_s = spectral_norm(self.conv_s)
 
         # define normalization layers
-        self.norm_0 = SPADE(n_channels_x=n_channels_x_in, norm_type=spade_norm)
-        self.norm_1 = SPADE(n_channels_x=n_channels_middle, norm_type=spade_norm)
+        self.share_segmap_mlp = share_segmap_mlp
+        n_channels_hidden = 128
+        kernel_size = [3, 3]
+        shared_mlp = None
+        if share_segmap_mlp:
+            shared_mlp = tf.layers.Conv2D(
+                n_channels_hidden, kernel_size, padding="SAME"
+            )
+        spade_kwargs = dict(
+            n_channels_hidden=n_channels_hidden,
+            norm_type=spade_norm,
+            kernel_size=kernel_size,
+            shared_mlp=shared_mlp,
+        )
+        self.norm_0 = SPADE(n_channels_x=n_channels_x_in, **spade_kwargs)
+        self.norm_1 = SPADE(n_channels_x=n_channels_middle, **spade_kwargs)
         if self.learned_shortcut:
-            self.norm_s = SPADE(n_channels_x=n_channels_x_in, norm_type=spade_norm)
+            self.norm_s = SPADE(n_channels_x=n_channels_x_in, **spade_kwargs)
 
     # note the resnet block with SPADE also takes in |seg|,
     # the semantic segmentation map as input
     def call(self, x, segmap):
-        x_s = self.shortcut(x, segmap)
-        dx = self.conv_0(self.actvn(self.norm_0(x, segmap)))
-        dx = self.conv_1(self.actvn(self.norm_1(dx, segmap)))
+        # resize segmap once and share it across all SPADE blocks
+        resized_segmap = resize_segmap(segmap, x.shape[1:3])
+        segmap_activation = None
+        if self.share_segmap_mlp:
+            segmap_activation = self.norm_0.segmap_activation(resized_segmap)
+        x_s = self.shortcut(
+            x,
+            segmap,
+            resized_segmap=resized_segmap,
+            segmap_activation=segmap_activation,
+        )
+        dx = self.conv_0(
+            self.actvn(
+                self.norm_0(
+                    x,
+                    segmap,
+                    resized_segmap=resized_segmap,
+                    segmap_activation=segmap_activation,
+                )
+            )
+        )
+        dx_segmap = resized_segmap
+        dx_size, x_size = dx.shape[1:3], x.shape[1:3]
+        if not (
+            dx_size.is_fully_defined()
+            and x_size.is_fully_defined()
+            and dx_size.as_list() == x_size.as_list()
+        ):
+            # resize from the original segmap, resizing twice loses information
+            dx_segmap = resize_segmap(segmap, dx_size)
+            if self.share_segmap_mlp:
+                segmap_activation = self.norm_1.segmap_activation(dx_segmap)
+        dx = self.conv_1(
+            self.actvn(
+                self.norm_1(
+                    dx,
+                    segmap,
+                    resized_segmap=dx_segmap,
+                    segmap_activation=segmap_activation,
+                )
+            )
+        )
         out = x_s + dx
         return out
 
-    def shortcut(self, x, segmap):
+    def shortcut(self, x, segmap, resized_segmap=None, segmap_activation=None):
         if self.learned_shortcut:
-            x_s = self.conv_s(self.norm_s(x, segmap))
+            x_s = self.conv_s(
+                self.norm_s(
+                    x,
+                    segmap,
+                    resized_segmap=resized_segmap,
+                    segmap_activation=segmap_activation,
+                )
+            )
         else:
             x_s = x
         return x_s
@@ -119,6 +184,7 @@ class SPADE(Layer):
         n_channels_hidden=128,
         norm_type=SPADEParamFreeNormType.BATCH_NORM,
         kernel_size=[3, 3],
+        shared_mlp=None,
     ):
         """SPADE operation.
         Each SPADE block implements a functional like f: x, segmap --> y
@@ -135,13 +201,20 @@ class SPADE(Layer):
             internal normalization for x, by default SPADEParamFreeNormType.BATCH_NORM
         kernel_size : list, optional
             by default [3, 3]
+        shared_mlp : tf.layers.Layer, optional
+            layer applied to the segmap before the gamma and beta convolutions.
+            Pass the same layer to several SPADE blocks to share it.
+            Its filters and kernel size have to match `n_channels_hidden` and
+            `kernel_size`. If None, a new Conv2D with `n_channels_hidden`
+            filters is created, by default None
 
         Raises
         ------
         NotImplementedError
             [description]
         ValueError
-            [description]
+            if `norm_type` is not recognized or `shared_mlp` does not match
+            `n_channels_hidden` and `kernel_size`
         """
         super().__init__()
         if norm_type == SPADEParamFreeNormType.INSTANCE_NORM:
@@ -159,22 +232,71 @@ class SPADE(Layer):
             )
         self.normalize = param_free_norm
 
-        self.shared_mlp = tf.layers.Conv2D(
-            n_channels_hidden, kernel_size, padding="SAME"
-        )
+        if shared_mlp is None:
+            shared_mlp = tf.layers.Conv2D(
+                n_channels_hidden, kernel_size, padding="SAME"
+            )
+        else:
+            if not isinstance(kernel_size, (list, tuple)):
+                kernel_size = [kernel_size] * 2
+            if shared_mlp.filters != n_channels_hidden or list(
+                shared_mlp.kernel_size
+            ) != list(kernel_size):
+                raise ValueError(
+                    "shared_mlp does not match n_channels_hidden and kernel_size"
+                )
+        self.shared_mlp = shared_mlp
         self.gamma_conv = tf.layers.Conv2D(n_channels_x, kernel_size, padding="SAME")
         self.beta_conv = tf.layers.Conv2D(n_channels_x, kernel_size, padding="SAME")
 
-    def call(self, x, segmap):
+    def call(self, x, segmap, resized_segmap=None, segmap_activation=None):
+        """Apply SPADE to `x` conditioned on `segmap`.
+
+        If `resized_segmap` is given, it is assumed to be `segmap` already
+        resized to the spatial shape of `x` and is used as is.
+        If `segmap_activation` is given, it is assumed to be the output of
+        `relu(shared_mlp(resized_segmap))` and replaces the `shared_mlp` pass.
+        """
         normalized = self.normalize(x)
-        segmap = tf.image.resize_nearest_neighbor(segmap, size=x.shape[1:3])
-        actv = tf.nn.relu(self.shared_mlp(segmap))
-        gamma = self.gamma_conv(actv)
-        beta = self.beta_conv(actv)
+        if segmap_activation is None:
+            if resized_segmap is None:
+                resized_segmap = resize_segmap(segmap, x.shape[1:3])
+            segmap_activation = self.segmap_activation(resized_segmap)
+        gamma = self.gamma_conv(segmap_activation)
+        beta = self.beta_conv(segmap_activation)
 
         out = normalized * (1 + gamma) + beta
         return out
 
+    def segmap_activation(self, resized_segmap):
+        return tf.nn.relu(self.shared_mlp(resized_segmap))
+
+
+def resize_segmap(segmap, size):
+    """Nearest neighbor resize of `segmap` to spatial `size`.
+
+    If the static spatial shape of `segmap` already equals `size`,
+    `segmap` is returned as is and no resize op is emitted.
+
+    Parameters
+    ----------
+    segmap : tf.Tensor
+        segmentation map shaped [N, H, W, C]
+    size : tf.TensorShape or list of ints
+        target spatial size [H_new, W_new]
+
+    Returns
+    -------
+    tf.Tensor
+        segmap shaped [N, H_new, W_new, C]
+    """
+    size = tf.TensorShape(size)
+    segmap_size = segmap.shape[1:3]
+    if size.is_fully_defined() and segmap_size.is_fully_defined():
+        if segmap_size.as_list() == size.as_list():
+            return segmap
+    return tf.image.resize_nearest_neighbor(segmap, size=size)
+
 
 class Residual(tfk.layers.Layer):
     def __init__(self, channels_in, kernel, **kwargs):
@@ -1,3 +1,4 @@
+import pytest
 import tensorflow as tf
 
 from ...tfutils import layers as smlayers
@@ -14,6 +15,11 @@ class Test_SPADE:
         spaded = smlayers.SPADE(n_channels_x=x.shape[-1])(x, m)
         assert spaded.shape == x.shape
 
+    def test_shared_mlp_mismatch(self):
+        shared_mlp = tf.layers.Conv2D(64, kernel_size=[3, 3], padding="SAME")
+        with pytest.raises(ValueError):
+            smlayers.SPADE(n_channels_hidden=128, shared_mlp=shared_mlp)
+
 
 class Test_SpadeResBlock:
     def test_no_shortcut(self):
@@ -32,6 +38,18 @@ class Test_SpadeResBlock:
         spaded = block(x, m)
         assert smnn.shape_as_list(spaded) == [2, 128, 128, 64]
 
+    def test_share_segmap_mlp(self):
+        x = tf.random_normal((2, 128, 128, 3))
+        m = tf.random.uniform((2, 64, 64), minval=0, maxval=9, dtype=tf.int32)
+        m = tf.one_hot(m, 10)
+        block = smlayers.SPADEResnetBlock(
+            n_channels_x_in=3, n_channels_x_out=64, share_segmap_mlp=True
+        )
+        spaded = block(x, m)
+        assert smnn.shape_as_list(spaded) == [2, 128, 128, 64]
+        assert block.norm_0.shared_mlp is block.norm_1.shared_mlp
+        assert block.norm_0.shared_mlp is block.norm_s.shared_mlp
+
 
 class Test_ResidualBlock:
     def test(self):